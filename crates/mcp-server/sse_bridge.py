@@ -10,45 +10,145 @@ Usage:
 """
 
 import asyncio
-import json
-import subprocess
+import itertools
+import os
+import re
+import socket
 import sys
-from typing import Optional
+from typing import Dict, List, Optional, Set
+import orjson
 from aiohttp import web
 import argparse
 import logging
 
+try:
+    import uvloop
+except ImportError:  # optional; falls back to the default asyncio loop
+    uvloop = None
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# MCP server stderr is appended here so history survives bridge restarts
+MCP_STDERR_LOG = '/tmp/mcp-server-stderr.log'
+
+# MCP tool results can be far larger than asyncio's default 64 KiB line limit
+MCP_STDOUT_LIMIT = 64 * 1024 * 1024
+
+# Finds the top-level id of an MCP response without parsing it; the server
+# serializes "id" right after "jsonrpc", before any nested object
+RESPONSE_ID_PATTERN = re.compile(rb'^\{[^{\[]*?"id"\s*:\s*(\d+)(?=\s*[,}])')
+
+# Top-level id of a client request, either as the first member (after "jsonrpc")
+# or as the last one; anything in between could be nested inside params
+_JSON_ID_VALUE = rb'(-?\d+|"(?:[^"\\]|\\.)*"|null)'
+REQUEST_ID_HEAD_PATTERN = re.compile(
+    rb'\{\s*(?:"jsonrpc"\s*:\s*"2\.0"\s*,\s*)?"id"\s*:\s*' + _JSON_ID_VALUE + rb'\s*[,}]'
+)
+REQUEST_ID_TAIL_PATTERN = re.compile(rb'[{,]\s*"id"\s*:\s*' + _JSON_ID_VALUE + rb'\s*\}$')
+
+# How far from the end of a request body to look for a trailing id
+REQUEST_ID_TAIL_WINDOW = 1024
+
+# Socket buffer for the MCP stdio socketpair; lets large results land in fewer reads
+MCP_STDIO_BUFFER_SIZE = 1024 * 1024
+
+# Seconds to wait for an MCP response; the server silently drops requests it can't parse
+DEFAULT_REQUEST_TIMEOUT = 600.0
+
+# Frames buffered per SSE client before the oldest ones are dropped
+SSE_CLIENT_QUEUE_SIZE = 256
+
+# Response headers for /sse; identity encoding keeps compression out of the stream
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Content-Encoding': 'identity',
+    'Access-Control-Allow-Origin': '*',
+}
+
+# Pre-rendered SSE framing
+ENDPOINT_FRAME = b"event: endpoint\ndata: /message\n\n"
+MESSAGE_PREFIX = b"event: message\ndata: "
+FRAME_SUFFIX = b"\n\n"
+
+# JSON-RPC internal error response; filled with the serialized id and message
+ERROR_RESPONSE_TEMPLATE = b'{"jsonrpc":"2.0","id":%s,"error":{"code":-32603,"message":%s}}'
+
+
+class SseClientQueue(asyncio.Queue):
+    """Per-client frame queue that remembers its slot in McpSseBridge.clients"""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.index: Optional[int] = None
+
 
 class McpSseBridge:
-    def __init__(self, binary_path: str):
+    def __init__(self, binary_path: str, mcp_cpus: Optional[Set[int]] = None,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
         self.binary_path = binary_path
-        self.process: Optional[subprocess.Popen] = None
-        self.clients = set()
+        self.request_timeout = request_timeout
+        # CPUs the MCP server is pinned to (None leaves scheduling to the OS)
+        self.mcp_cpus = mcp_cpus
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # Our end of the socketpair used as the server's stdin/stdout
+        self._mcp_reader: Optional[asyncio.StreamReader] = None
+        self._mcp_writer: Optional[asyncio.StreamWriter] = None
+        # Enable debug logging for MCP server; built once and reused across restarts
+        self._env = {**os.environ, 'RUST_LOG': 'debug'}
+        self.clients: List[SseClientQueue] = []
+        # In-flight requests keyed by bridge-assigned id, resolved by the stdout reader task.
+        # Clients number their own requests, so their ids can collide and are never sent to MCP.
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+        self._reader_task: Optional[asyncio.Task] = None
+        self._stderr_fd: Optional[int] = None
+        # Keeps each request line intact when several writers share stdin
+        self._write_lock = asyncio.Lock()
         
     async def start_mcp_server(self):
         """Start the MCP server subprocess"""
         logger.info(f"Starting MCP server: {self.binary_path}")
 
-        # Enable debug logging for MCP server
-        import os
-        env = os.environ.copy()
-        env['RUST_LOG'] = 'debug'
-
-        # Open stderr log file
-        stderr_log = open('/tmp/mcp-server-stderr.log', 'w')
-
-        self.process = subprocess.Popen(
-            [self.binary_path],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=stderr_log,
-            bufsize=0,
-            env=env,
+        # Open stderr log file as a raw fd; the child writes to it directly
+        self._stderr_fd = os.open(
+            MCP_STDERR_LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644
+        )
+
+        # A Unix socketpair instead of pipes gives tunable, larger stdio buffers
+        parent_sock, child_sock = socket.socketpair()
+        parent_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MCP_STDIO_BUFFER_SIZE)
+        child_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MCP_STDIO_BUFFER_SIZE)
+
+        # Pin in the child before exec so every thread the server starts inherits the mask
+        preexec_fn = None
+        if self.mcp_cpus and hasattr(os, 'sched_setaffinity'):
+            cpus = self.mcp_cpus
+            preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                self.binary_path,
+                stdin=child_sock.fileno(),
+                stdout=child_sock.fileno(),
+                stderr=self._stderr_fd,
+                env=self._env,
+                preexec_fn=preexec_fn,
+            )
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            # The child holds its own copies of this end
+            child_sock.close()
+
+        self._mcp_reader, self._mcp_writer = await asyncio.open_unix_connection(
+            sock=parent_sock, limit=MCP_STDOUT_LIMIT
         )
-        logger.info("MCP server started, stderr logging to /tmp/mcp-server-stderr.log")
+        self._reader_task = asyncio.create_task(self._read_responses())
+        logger.info(f"MCP server started, stderr logging to {MCP_STDERR_LOG}")
 
     async def stop_mcp_server(self):
         """Stop the MCP server subprocess"""
@@ -56,59 +156,197 @@ class McpSseBridge:
             logger.info("Stopping MCP server")
             self.process.terminate()
             try:
-                self.process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
                 self.process.kill()
+                await self.process.wait()
             logger.info("MCP server stopped")
-            
-    async def send_to_mcp(self, message: dict) -> dict:
-        """Send a message to the MCP server and get response"""
-        if not self.process:
-            raise RuntimeError("MCP server not started")
-
-        # Send message
-        message_json = json.dumps(message) + '\n'
-        logger.debug(f"Sending to MCP: {message_json.strip()}")
-        self.process.stdin.write(message_json.encode())
-        self.process.stdin.flush()
+        if self._reader_task:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+        if self._mcp_writer:
+            self._mcp_writer.close()
+            self._mcp_writer = None
+            self._mcp_reader = None
+        if self._stderr_fd is not None:
+            os.close(self._stderr_fd)
+            self._stderr_fd = None
+
+    def is_healthy(self) -> bool:
+        """Check the MCP server without a syscall; the event loop's child watcher keeps returncode current"""
+        return (
+            self.process is not None
+            and self.process.returncode is None
+            and self._reader_task is not None
+            and not self._reader_task.done()
+        )
 
-        # Read response - skip any non-JSON lines (logs)
+    async def _skip_oversized_line(self) -> bytes:
+        """Discard the rest of a stdout line longer than MCP_STDOUT_LIMIT and return its head"""
+        head = await self._mcp_reader.read(256)
         while True:
-            response_line = self.process.stdout.readline()
-            if not response_line:
-                raise RuntimeError("MCP server closed connection")
-
-            line = response_line.decode().strip()
-            if not line:
-                continue
+            try:
+                await self._mcp_reader.readuntil(b'\n')
+                return head
+            except asyncio.LimitOverrunError as e:
+                # Data is left buffered on overrun; drop what was scanned and keep looking
+                await self._mcp_reader.readexactly(e.consumed)
+            except asyncio.IncompleteReadError:
+                return head
+
+    async def _read_responses(self):
+        """Read MCP stdout and route each response to the caller waiting on its id"""
+        try:
+            while True:
+                try:
+                    response_line = await self._mcp_reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    response_line = e.partial
+                except asyncio.LimitOverrunError:
+                    # Fail only the request the oversized response belongs to
+                    head = await self._skip_oversized_line()
+                    match = RESPONSE_ID_PATTERN.match(head)
+                    future = self._pending.pop(int(match.group(1)), None) if match else None
+                    logger.error(f"Dropped MCP output line longer than {MCP_STDOUT_LIMIT} bytes: {head[:100]}")
+                    if future is not None and not future.done():
+                        future.set_exception(RuntimeError(
+                            f"MCP response exceeded the {MCP_STDOUT_LIMIT} byte line limit"
+                        ))
+                    continue
+                if not response_line:
+                    break
+
+                # JSON-RPC messages always start with '{'; anything else is a
+                # log line and is skipped without invoking the parser
+                if response_line[:1] != b'{':
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Skipping non-JSON line: %s", response_line[:100])
+                    continue
+
+                line = response_line.rstrip()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Received from MCP: %s", line[:200])
+
+                # Bridge ids are plain ints; lines without one (notifications, or ids
+                # that are arrays, objects or bools) can't be ours. The line is never
+                # parsed: callers forward it with the id spliced back in.
+                match = RESPONSE_ID_PATTERN.match(line)
+                future = self._pending.pop(int(match.group(1)), None) if match else None
+                if future is None:
+                    logger.warning(f"Dropping MCP message with no pending request: {line[:200]}")
+                elif not future.done():
+                    future.set_result((line, match.span(1)))
+        except Exception as e:
+            logger.error(f"MCP reader failed: {e}")
+            # Nothing reads its stdout any more; stop the server rather than leave it half-alive
+            if self.process and self.process.returncode is None:
+                self.process.terminate()
+        finally:
+            # Fail anything still waiting so callers don't hang forever
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(RuntimeError("MCP server closed connection"))
+
+    async def send_raw_to_mcp(self, message: dict, body: bytes) -> bytes:
+        """Send a JSON-RPC request body and get the raw response line carrying the request's id"""
+        if not self.process:
+            raise RuntimeError("MCP server not started")
+        if self._reader_task is None or self._reader_task.done():
+            raise RuntimeError("MCP server closed connection")
+
+        # Send under a bridge-unique id so concurrent clients reusing an id can't collide
+        request_id = next(self._request_ids)
+        payload = splice_request_id(body, message, request_id)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+
+        try:
+            # Send message; the reader task delivers the matching response
+            async with self._write_lock:
+                logger.debug("Sending to MCP: %s", payload)
+                self._mcp_writer.write(payload + b'\n')
+                await self._mcp_writer.drain()
 
-            # Try to parse as JSON
             try:
-                response = json.loads(line)
-                logger.debug(f"Received from MCP: {json.dumps(response)[:200]}")
-                return response
-            except json.JSONDecodeError:
-                # This is a log line, skip it
-                logger.debug(f"Skipping non-JSON line: {line[:100]}")
-                continue
+                line, (start, end) = await asyncio.wait_for(future, timeout=self.request_timeout)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"MCP server did not respond within {self.request_timeout:g}s")
+        finally:
+            self._pending.pop(request_id, None)
+
+        return line[:start] + orjson.dumps(message['id']) + line[end:]
         
-    async def broadcast_to_clients(self, message: dict):
-        """Broadcast a message to all SSE clients"""
-        message_json = json.dumps(message)
-        dead_clients = set()
+    def add_client(self, client_queue: SseClientQueue):
+        """Register an SSE client queue"""
+        client_queue.index = len(self.clients)
+        self.clients.append(client_queue)
+
+    def remove_client(self, client_queue: SseClientQueue):
+        """Unregister an SSE client queue in O(1) by swapping the last client into its slot"""
+        index = client_queue.index
+        if index is None:
+            return
+        last = self.clients.pop()
+        if last is not client_queue:
+            self.clients[index] = last
+            last.index = index
+        client_queue.index = None
+
+    @staticmethod
+    def _enqueue_frame(client_queue: SseClientQueue, frame: bytes):
+        """Queue a frame for one client without waiting, dropping its oldest frame if full"""
+        try:
+            client_queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Slow consumer: drop its oldest frame rather than grow without bound
+            client_queue.get_nowait()
+            client_queue.put_nowait(frame)
+            logger.warning("SSE client queue full, dropped oldest message")
+
+    async def broadcast_raw_to_clients(self, payload: bytes):
+        """Broadcast an already serialized single-line JSON message to all SSE clients
+
+        Enqueueing never awaits, so the whole fanout happens in one scheduler
+        pass and a slow client cannot hold up delivery to the others.
+        """
+        # Build the SSE frame once; every client queue shares the same bytes
+        frame = MESSAGE_PREFIX + payload + FRAME_SUFFIX
+        dead_clients = []
 
         logger.info(f"Broadcasting to {len(self.clients)} clients")
 
         for client_queue in self.clients:
             try:
-                await client_queue.put(message_json)
-                logger.debug(f"Sent to client queue")
+                self._enqueue_frame(client_queue, frame)
+                logger.debug("Sent to client queue")
             except Exception as e:
                 logger.warning(f"Failed to send to client: {e}")
-                dead_clients.add(client_queue)
+                dead_clients.append(client_queue)
 
         # Remove dead clients
-        self.clients -= dead_clients
+        for client_queue in dead_clients:
+            self.remove_client(client_queue)
+
+
+def splice_request_id(body: bytes, message: dict, request_id: int) -> bytes:
+    """Swap the client's top-level id in a request body for the bridge id
+
+    The body is only re-serialized when its id can't be located safely, or
+    when it spans several lines (stdio framing is one message per line).
+    """
+    if b'\n' not in body:
+        match = REQUEST_ID_HEAD_PATTERN.match(body)
+        if match is None:
+            match = REQUEST_ID_TAIL_PATTERN.search(body, max(len(body) - REQUEST_ID_TAIL_WINDOW, 0))
+        # Guard against a look-alike inside a string by checking the decoded value
+        if match is not None and orjson.loads(match.group(1)) == message['id']:
+            start, end = match.span(1)
+            return body[:start] + str(request_id).encode() + body[end:]
+    return orjson.dumps({**message, 'id': request_id})
 
 
 # Global bridge instance
@@ -117,32 +355,36 @@ bridge: Optional[McpSseBridge] = None
 
 async def sse_handler(request):
     """SSE endpoint - streams responses to clients"""
-    response = web.StreamResponse()
-    response.headers['Content-Type'] = 'text/event-stream'
-    response.headers['Cache-Control'] = 'no-cache'
-    response.headers['Connection'] = 'keep-alive'
-    response.headers['Access-Control-Allow-Origin'] = '*'
+    response = web.StreamResponse(headers=SSE_HEADERS)
     
     await response.prepare(request)
+
+    # SSE frames are small and latency-sensitive: make sure Nagle never holds them back
+    sock = request.transport.get_extra_info('socket') if request.transport else None
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     
     # Create a queue for this client
-    client_queue = asyncio.Queue()
-    bridge.clients.add(client_queue)
+    client_queue = SseClientQueue(maxsize=SSE_CLIENT_QUEUE_SIZE)
+    bridge.add_client(client_queue)
     
     logger.info("SSE client connected")
     
     try:
         # Send endpoint event (just the path, not JSON)
-        await response.write(f"event: endpoint\ndata: /message\n\n".encode())
+        await response.write(ENDPOINT_FRAME)
         logger.info("Sent endpoint event")
 
         # Stream messages to client
         while True:
-            message = await client_queue.get()
-            logger.debug(f"Streaming message to SSE client: {message[:100]}")
-            event_data = f"event: message\ndata: {message}\n\n"
+            # Drain everything already queued so a burst goes out in one write
+            frames = [await client_queue.get()]
+            while not client_queue.empty():
+                frames.append(client_queue.get_nowait())
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Streaming %d message(s) to SSE client: %s", len(frames), frames[0][:100])
             try:
-                await response.write(event_data.encode())
+                await response.write(b"".join(frames))
             except Exception as e:
                 logger.warning(f"Failed to write to SSE client: {e}")
                 break
@@ -152,7 +394,7 @@ async def sse_handler(request):
     except Exception as e:
         logger.error(f"SSE handler error: {e}")
     finally:
-        bridge.clients.discard(client_queue)
+        bridge.remove_client(client_queue)
         logger.info(f"SSE client removed, {len(bridge.clients)} clients remaining")
         
     return response
@@ -160,8 +402,11 @@ async def sse_handler(request):
 
 async def message_handler(request):
     """Message endpoint - receives JSON-RPC requests"""
+    message = None
     try:
-        message = await request.json()
+        body = (await request.read()).strip()
+        # Only peek at the request; the body itself is forwarded with just its id swapped
+        message = orjson.loads(body)
         logger.info(f"Received message: {message.get('method', 'unknown')}")
         
         # Handle notification (no response needed)
@@ -170,30 +415,24 @@ async def message_handler(request):
             return web.Response(status=200)
         
         # Send to MCP server and get response
-        response = await bridge.send_to_mcp(message)
+        response = await bridge.send_raw_to_mcp(message, body)
         
         # Broadcast response to SSE clients
-        await bridge.broadcast_to_clients(response)
+        await bridge.broadcast_raw_to_clients(response)
         
         # Also return as HTTP response
-        return web.json_response(response)
+        return web.Response(body=response, content_type='application/json')
         
     except Exception as e:
         logger.error(f"Error handling message: {e}", exc_info=True)
-        error_response = {
-            "jsonrpc": "2.0",
-            "id": message.get('id') if 'message' in locals() else None,
-            "error": {
-                "code": -32603,
-                "message": str(e)
-            }
-        }
-        return web.json_response(error_response, status=500)
+        message_id = message.get('id') if isinstance(message, dict) else None
+        error_response = ERROR_RESPONSE_TEMPLATE % (orjson.dumps(message_id), orjson.dumps(str(e)))
+        return web.Response(body=error_response, status=500, content_type='application/json')
 
 
 async def health_handler(request):
     """Health check endpoint"""
-    if bridge and bridge.process and bridge.process.poll() is None:
+    if bridge and bridge.is_healthy():
         return web.json_response({"status": "healthy"})
     else:
         return web.json_response({"status": "unhealthy"}, status=503)
@@ -209,6 +448,23 @@ async def cleanup_background_tasks(app):
     await bridge.stop_mcp_server()
 
 
+def parse_cpu_list(value: str) -> Set[int]:
+    """Parse a CPU list such as '1', '0,2' or '2-3' for argparse"""
+    cpus = set()
+    for part in value.split(','):
+        start, dash, end = part.partition('-')
+        try:
+            # int('') rejects empty bounds such as '1-' or '-1'
+            first = int(start)
+            last = int(end) if dash else first
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid CPU list: {value!r}")
+        if first > last:
+            raise argparse.ArgumentTypeError(f"invalid CPU range {part!r} in {value!r}")
+        cpus.update(range(first, last + 1))
+    return cpus
+
+
 def main():
     parser = argparse.ArgumentParser(description='SSE Bridge for Smart Diff MCP Server')
     parser.add_argument('--port', type=int, default=8011, help='Port to listen on (default: 8011)')
@@ -216,10 +472,38 @@ def main():
                        default='./target/release/smart-diff-mcp',
                        help='Path to MCP server binary')
     parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to bind to')
+    parser.add_argument('--bridge-cpus', type=parse_cpu_list, default=None,
+                       help='Pin the bridge to these CPUs, e.g. "0" (Linux only)')
+    parser.add_argument('--mcp-cpus', type=parse_cpu_list, default=None,
+                       help='Pin the MCP server to these CPUs, e.g. "1-3" (Linux only)')
+    parser.add_argument('--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                       help=f'Seconds to wait for each MCP response (default: {DEFAULT_REQUEST_TIMEOUT:g})')
     args = parser.parse_args()
+
+    mcp_cpus = args.mcp_cpus
+    if args.bridge_cpus or args.mcp_cpus:
+        if not hasattr(os, 'sched_setaffinity'):
+            logger.warning("CPU pinning is not supported on this platform, ignoring")
+            mcp_cpus = None
+        else:
+            # Reject CPUs we may not run on up front; for the server a bad mask would
+            # otherwise only surface as an opaque preexec_fn failure at startup
+            available = os.sched_getaffinity(0)
+            for flag, cpus in (('--bridge-cpus', args.bridge_cpus), ('--mcp-cpus', args.mcp_cpus)):
+                if cpus and not cpus <= available:
+                    parser.error(f"{flag}: CPUs {sorted(cpus - available)} are not available "
+                                 f"(usable CPUs: {sorted(available)})")
+            if args.bridge_cpus:
+                # The server would otherwise inherit the bridge's mask and share its CPUs
+                if mcp_cpus is None:
+                    mcp_cpus = available
+                os.sched_setaffinity(0, args.bridge_cpus)
+                logger.info(f"Bridge pinned to CPUs {sorted(args.bridge_cpus)}")
+    if mcp_cpus and args.mcp_cpus:
+        logger.info(f"MCP server will be pinned to CPUs {sorted(mcp_cpus)}")
     
     global bridge
-    bridge = McpSseBridge(args.binary)
+    bridge = McpSseBridge(args.binary, mcp_cpus=mcp_cpus, request_timeout=args.request_timeout)
     
     app = web.Application()
     app.router.add_get('/sse', sse_handler)
@@ -233,8 +517,13 @@ def main():
     logger.info(f"SSE endpoint: http://{args.host}:{args.port}/sse")
     logger.info(f"Message endpoint: http://{args.host}:{args.port}/message")
     logger.info(f"Health endpoint: http://{args.host}:{args.port}/health")
+
+    loop = None
+    if uvloop is not None:
+        logger.info("Using uvloop event loop")
+        loop = uvloop.new_event_loop()
     
-    web.run_app(app, host=args.host, port=args.port)
+    web.run_app(app, host=args.host, port=args.port, access_log=None, loop=loop)
 
 
 if __name__ == '__main__':